@@ -33,9 +33,1071 @@ Assumption about the instance:
 
 """
 
-from collections import defaultdict
+import os
+import random
+import struct
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import defaultdict, namedtuple
+from multiprocessing import Pool, resource_tracker, shared_memory
 from quark_trajectories import QuarkTrajectory
 from itertools import combinations
+from math import isqrt
+from operator import le
+from statistics import NormalDist
+
+
+Estimate = namedtuple("Estimate", ["expected", "lower", "upper", "samples"])
+
+
+# magic, version, big endian, int and float typecodes, trajectories and
+# the length of each side's pivot
+_PREPARED_HEADER = struct.Struct("<8sH?ccQQQQ")
+_PREPARED_MAGIC = b"QTPIVOTS"
+_PREPARED_VERSION = 1
+_PREPARED_TYPECODES = {('q', 'd'), ('I', 'f')}
+
+
+def trajectories_meet(first, second) -> bool:
+    """
+    Two trajectories meet iff their endpoints interleave along the perimeter.
+    :param first: QuarkTrajectory
+    :param second: QuarkTrajectory
+    :return: True if first and second meet inside the triangle
+    """
+
+    # (s, alpha) rather than s + alpha, which merges alphas closer than an ulp
+    a = (first.start.s, first.start.alpha)
+    b = (first.end.s, first.end.alpha)
+    c = (second.start.s, second.start.alpha)
+    d = (second.end.s, second.end.alpha)
+    if b < a:
+        a, b = b, a
+
+    return (a < c < b) != (a < d < b)
+
+
+def _ends_on_prev_side(key):
+    """
+    :param key: end key produced by PreparedSystem
+    :return: True if the end lies on the previous side of the pivot
+    """
+
+    return key & 1 == 1
+
+
+def _merge_runs(keys, probabilities, merged_keys, merged_probabilities,
+                lo, mid, hi):
+    """
+    Merge the runs [lo, mid) and [mid, hi), each sorted by end key, into the
+    same slots of merged_keys and merged_probabilities, counting the
+    entanglements between every left trajectory and every right trajectory.
+    Left trajectories must start before right trajectories on the pivot side.
+
+    The merge runs from the largest end key down, keeping the sums of the
+    right probabilities that end after the current left trajectory.
+
+    :param keys: end keys of the pivoted trajectories
+    :param probabilities: probabilities of the pivoted trajectories
+    :return: Expected number of entanglements
+    """
+
+    sum_next_side = 0.0
+    sum_prev_side = 0.0
+    expected = 0.0
+    left_index = mid - 1
+    right_index = hi - 1
+    out = hi - 1
+    while left_index >= lo:
+        key = keys[left_index]
+        if right_index >= mid and keys[right_index] > key:
+            right_key = keys[right_index]
+            probability = probabilities[right_index]
+            if _ends_on_prev_side(right_key):
+                sum_prev_side += probability
+            else:
+                sum_next_side += probability
+            merged_keys[out] = right_key
+            merged_probabilities[out] = probability
+            right_index -= 1
+        else:
+            probability = probabilities[left_index]
+
+            # same side ends are counted from both pivots, so count half
+            if _ends_on_prev_side(key):
+                expected += probability * (
+                    sum_next_side + sum_prev_side * 0.5)
+            else:
+                expected += probability * (
+                    sum_next_side * 0.5 + sum_prev_side)
+            merged_keys[out] = key
+            merged_probabilities[out] = probability
+            left_index -= 1
+        out -= 1
+
+    # the rest of the right run ends before every left trajectory
+    merged_keys[lo:out + 1] = keys[mid:right_index + 1]
+    merged_probabilities[lo:out + 1] = probabilities[mid:right_index + 1]
+
+    return expected
+
+
+def _sort_and_count(keys, probabilities):
+    """
+    Bottom up merge_and_count over a pivot held in typed arrays, merging
+    runs of width 1, 2, 4, ... between two pairs of buffers of the same
+    typecodes, so a compact pivot is swept in uint32 / float32.
+
+    :param keys: array of end keys ordered by start alpha
+    :param probabilities: array of probabilities ordered by start alpha
+    :return: Expected number of entanglements
+    """
+
+    n = len(keys)
+    keys, merged_keys = array(keys.typecode, keys), array(keys.typecode, keys)
+    probabilities, merged_probabilities = (
+        array(probabilities.typecode, probabilities),
+        array(probabilities.typecode, probabilities))
+
+    expected = 0.0
+    width = 1
+    while width < n:
+        level = 0.0
+        for lo in range(0, n, 2 * width):
+            mid = min(lo + width, n)
+            hi = min(lo + 2 * width, n)
+            level += _merge_runs(keys, probabilities, merged_keys,
+                                 merged_probabilities, lo, mid, hi)
+        expected += level
+
+        keys, merged_keys = merged_keys, keys
+        probabilities, merged_probabilities = merged_probabilities, probabilities
+        width *= 2
+
+    return expected
+
+
+def _worker_pool(processes):
+    """
+    Start a Pool for count_side_parallel. The resource tracker is started
+    first so the workers share it; a worker started before it would track
+    the pivots it attaches to and report them as leaked.
+    """
+
+    resource_tracker.ensure_running()
+
+    return Pool(processes)
+
+
+def _shared_slots(shared, lo, hi):
+    """
+    :param shared: (name, n, key typecode, probability typecode) of a pivot
+                   in shared memory, n keys followed by n probabilities
+    :return: byte ranges of the keys and probabilities in [lo, hi)
+    """
+
+    _, n, key_code, probability_code = shared
+    key_size = array(key_code).itemsize
+    probability_size = array(probability_code).itemsize
+    offset = key_size * n
+
+    return ((key_size * lo, key_size * hi),
+            (offset + probability_size * lo, offset + probability_size * hi))
+
+
+def _attach_pivot(shared, lo, hi):
+    """
+    Copy the block [lo, hi) of a pivot published in shared memory by
+    count_side_parallel.
+    :return: (keys, probabilities) arrays of the block
+    """
+
+    name, _, key_code, probability_code = shared
+    key_slot, probability_slot = _shared_slots(shared, lo, hi)
+
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        keys = array(key_code)
+        keys.frombytes(shm.buf[key_slot[0]:key_slot[1]])
+        probabilities = array(probability_code)
+        probabilities.frombytes(shm.buf[probability_slot[0]:probability_slot[1]])
+    finally:
+        shm.close()
+
+    return keys, probabilities
+
+
+def _publish_pivot(shm, shared, lo, keys, probabilities):
+    """
+    Copy the keys and probabilities arrays into [lo, lo + len(keys)) of a
+    pivot in shared memory.
+    """
+
+    key_slot, probability_slot = _shared_slots(shared, lo, lo + len(keys))
+    with shm.buf[key_slot[0]:key_slot[1]] as view, \
+            view.cast(keys.typecode) as typed:
+        typed[:] = keys
+    with shm.buf[probability_slot[0]:probability_slot[1]] as view, \
+            view.cast(probabilities.typecode) as typed:
+        typed[:] = probabilities
+
+
+def _key_range(key, n, processes):
+    """
+    :return: which of processes equal ranges of end ranks key falls in
+    """
+
+    return (key >> 1) * processes // n
+
+
+def _count_block(args):
+    """
+    Worker: count the entanglements in the block [lo, hi) of a shared pivot
+    between trajectories whose end keys fall in different key ranges, and
+    sum the block probabilities by key range and end side.
+    """
+
+    shared, lo, hi, processes = args
+    keys, probabilities = _attach_pivot(shared, lo, hi)
+    n = shared[1]
+
+    counts = [0] * processes
+    sums = [[0.0, 0.0] for _ in range(processes)]
+    trees = [FenwickTree(processes), FenwickTree(processes)]
+    expected = 0.0
+    for key, probability in zip(keys, probabilities):
+        r = _key_range(key, n, processes)
+        flag = 1 if _ends_on_prev_side(key) else 0
+
+        # same side ends are counted from both pivots, so count half
+        expected += probability * (
+            trees[flag].prefix_sum(r) * 0.5 + trees[1 - flag].prefix_sum(r))
+
+        trees[flag].add(r, probability)
+        counts[r] += 1
+        sums[r][flag] += probability
+
+    return counts, sums, expected
+
+
+def _scatter_block(args):
+    """
+    Worker: copy the block [lo, hi) of a shared pivot into the shared pivot
+    grouped by key range, starting at offsets[r] for key range r.
+    """
+
+    shared, ranges, lo, hi, processes, offsets = args
+    keys, probabilities = _attach_pivot(shared, lo, hi)
+    n = shared[1]
+
+    range_keys = [array(keys.typecode) for _ in range(processes)]
+    range_probabilities = [array(probabilities.typecode) for _ in range(processes)]
+    for key, probability in zip(keys, probabilities):
+        r = _key_range(key, n, processes)
+        range_keys[r].append(key)
+        range_probabilities[r].append(probability)
+
+    shm = shared_memory.SharedMemory(name=ranges[0])
+    try:
+        for r in range(processes):
+            _publish_pivot(shm, ranges, offsets[r],
+                           range_keys[r], range_probabilities[r])
+    finally:
+        shm.close()
+
+
+def _count_range(args):
+    """
+    Worker: sort and count the trajectories of one key range, stored in
+    start order in [lo, hi) of the shared pivot grouped by key range.
+    """
+
+    shared, lo, hi = args
+    keys, probabilities = _attach_pivot(shared, lo, hi)
+
+    return _sort_and_count(keys, probabilities)
+
+
+def count_side_parallel(keys, probabilities, processes, pool=None):
+    """
+    Divide and conquer merge_and_count over several processes.
+
+    The pivot is split into processes contiguous blocks by start alpha, and
+    the end ranks into processes equal key ranges. A pair of trajectories
+    whose ends fall in different key ranges is counted either inside its
+    block, or from the per block sums by key range with prefix sums. A pair
+    whose ends fall in the same key range is counted by sorting and counting
+    that key range, gathered from all blocks in start order.
+
+    The pivot arrays are copied once into shared memory with their own
+    typecodes, each worker only copies its own block or key range out of
+    it, and no phase needs the fully merged order. The blocks, the key
+    ranges and the summation order only depend on the pivot size and
+    processes, so the result is deterministic.
+
+    :param keys: array of end keys ordered by start alpha, see pivot_keys
+    :param probabilities: array of probabilities ordered by start alpha
+    :param processes: number of blocks and key ranges
+    :param pool: multiprocessing Pool to run on, started after the resource
+                 tracker as in _worker_pool; one of processes workers is
+                 started if not given
+    :return: Expected number of entanglements
+    """
+
+    if pool is None:
+        with _worker_pool(processes) as pool:
+            return count_side_parallel(keys, probabilities, processes, pool)
+
+    n = len(keys)
+    bounds = [n * i // processes for i in range(processes + 1)]
+    size = max(n * (keys.itemsize + probabilities.itemsize), 1)
+
+    pivot_shm = shared_memory.SharedMemory(create=True, size=size)
+    try:
+        ranges_shm = shared_memory.SharedMemory(create=True, size=size)
+        try:
+            pivot = (pivot_shm.name, n, keys.typecode, probabilities.typecode)
+            ranges = (ranges_shm.name, n, keys.typecode, probabilities.typecode)
+            _publish_pivot(pivot_shm, pivot, 0, keys, probabilities)
+
+            blocks = pool.map(_count_block, [
+                (pivot, bounds[a], bounds[a + 1], processes)
+                for a in range(processes)
+            ])
+
+            expected = 0.0
+            for _, _, block_expected in blocks:
+                expected += block_expected
+
+            # pairs from an earlier block ending in a lower key range
+            earlier = [[0.0, 0.0] for _ in range(processes)]
+            for _, sums, _ in blocks:
+                below = [0.0, 0.0]
+                for r in range(processes):
+                    for flag in (0, 1):
+                        expected += sums[r][flag] * (
+                            below[flag] * 0.5 + below[1 - flag])
+                    for flag in (0, 1):
+                        below[flag] += earlier[r][flag]
+                for r in range(processes):
+                    for flag in (0, 1):
+                        earlier[r][flag] += sums[r][flag]
+
+            # group by key range, each range in start order
+            offsets = []
+            range_bounds = [0]
+            for r in range(processes):
+                offset = range_bounds[-1]
+                for a in range(processes):
+                    if r == 0:
+                        offsets.append([0] * processes)
+                    offsets[a][r] = offset
+                    offset += blocks[a][0][r]
+                range_bounds.append(offset)
+
+            pool.map(_scatter_block, [
+                (pivot, ranges, bounds[a], bounds[a + 1], processes, offsets[a])
+                for a in range(processes)
+            ])
+
+            for range_expected in pool.map(_count_range, [
+                (ranges, range_bounds[r], range_bounds[r + 1])
+                for r in range(processes)
+            ]):
+                expected += range_expected
+        finally:
+            ranges_shm.close()
+            ranges_shm.unlink()
+    finally:
+        pivot_shm.close()
+        pivot_shm.unlink()
+
+    return expected
+
+
+def _merge_runs_by_group(keys, probabilities, groups, left, right, matrix):
+    """
+    Same as _merge_runs, but the entanglements of each left trajectory are
+    split by the group of the right trajectory and added to matrix.
+
+    The merge runs from the largest end key down, keeping per group sums of
+    the right trajectories that end after the current left trajectory.
+
+    :param groups: group number of the pivoted trajectories
+    :param matrix: matrix[g][h] accumulates entanglements between a left
+                   trajectory in group g and a right trajectory in group h
+    :return: Merged indices
+    """
+
+    n_groups = len(matrix)
+    sum_next_side = [0.0] * n_groups
+    sum_prev_side = [0.0] * n_groups
+
+    merged = [0] * (len(left) + len(right))
+    left_index = len(left) - 1
+    right_index = len(right) - 1
+    while left_index >= 0:
+        pos = left_index + right_index + 1
+        if right_index >= 0 and keys[right[right_index]] > keys[left[left_index]]:
+            traj = right[right_index]
+            right_index -= 1
+            if _ends_on_prev_side(keys[traj]):
+                sum_prev_side[groups[traj]] += probabilities[traj]
+            else:
+                sum_next_side[groups[traj]] += probabilities[traj]
+        else:
+            traj = left[left_index]
+            left_index -= 1
+            p = probabilities[traj]
+            row = matrix[groups[traj]]
+            # right trajectories ending after a prev side end are on prev side
+            if _ends_on_prev_side(keys[traj]):
+                for h in range(n_groups):
+                    row[h] += p * sum_prev_side[h] * 0.5
+            else:
+                for h in range(n_groups):
+                    row[h] += p * (sum_next_side[h] * 0.5 + sum_prev_side[h])
+        merged[pos] = traj
+
+    merged[:right_index + 1] = right[:right_index + 1]
+
+    return merged
+
+
+def _sort_and_count_by_group(keys, probabilities, groups, order, matrix):
+    """
+    Index based merge_and_count that accumulates entanglements per pair of
+    groups into matrix.
+
+    :param order: indices sorted by start alpha
+    :return: Indices sorted by end key
+    """
+
+    if len(order) <= 1:
+        return list(order)
+
+    mid = len(order) // 2
+    left = _sort_and_count_by_group(
+        keys, probabilities, groups, order[:mid], matrix)
+    right = _sort_and_count_by_group(
+        keys, probabilities, groups, order[mid:], matrix)
+
+    return _merge_runs_by_group(
+        keys, probabilities, groups, left, right, matrix)
+
+
+class FenwickTree:
+    """
+    Binary indexed tree of n slots, for prefix sums under point updates.
+    """
+
+    def __init__(self, n: int):
+        """
+        Initialise n empty slots
+        :param n: number of slots
+        """
+
+        self.tree = [0.0] * (n + 1)
+
+    def add(self, i: int, value: float):
+        """
+        Add value to slot i.
+        """
+
+        i += 1
+        while i < len(self.tree):
+            self.tree[i] += value
+            i += i & -i
+
+    def prefix_sum(self, i: int) -> float:
+        """
+        :return: sum of slots [0, i)
+        """
+
+        total = 0.0
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+
+        return total
+
+
+def _first_pair_at_least(probability, sorted_probabilities, threshold):
+    """
+    :return: index of the first p in sorted_probabilities with
+             probability * p >= threshold
+    """
+
+    lo, hi = 0, len(sorted_probabilities)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if probability * sorted_probabilities[mid] >= threshold:
+            hi = mid
+        else:
+            lo = mid + 1
+
+    return lo
+
+
+def _merge_runs_thresholds(keys, probabilities, left, right, thresholds, totals):
+    """
+    Same as _merge_runs, but only counts pairs with p_i * p_j >= threshold,
+    adding the count for thresholds[t] to totals[t].
+
+    The right trajectories that end after the current left trajectory are
+    kept in Fenwick trees indexed by probability rank, so the pairs above
+    each threshold are a suffix sum.
+
+    :return: Merged indices
+    """
+
+    rank_order = sorted(range(len(right)), key=lambda i: probabilities[right[i]])
+    rank = [0] * len(right)
+    for r, i in enumerate(rank_order):
+        rank[i] = r
+    sorted_probabilities = [probabilities[right[i]] for i in rank_order]
+
+    tree_next_side = FenwickTree(len(right))
+    tree_prev_side = FenwickTree(len(right))
+    sum_next_side = 0.0
+    sum_prev_side = 0.0
+
+    merged = [0] * (len(left) + len(right))
+    left_index = len(left) - 1
+    right_index = len(right) - 1
+    while left_index >= 0:
+        pos = left_index + right_index + 1
+        if right_index >= 0 and keys[right[right_index]] > keys[left[left_index]]:
+            traj = right[right_index]
+            if _ends_on_prev_side(keys[traj]):
+                tree_prev_side.add(rank[right_index], probabilities[traj])
+                sum_prev_side += probabilities[traj]
+            else:
+                tree_next_side.add(rank[right_index], probabilities[traj])
+                sum_next_side += probabilities[traj]
+            right_index -= 1
+        else:
+            traj = left[left_index]
+            left_index -= 1
+            p = probabilities[traj]
+            for t, threshold in enumerate(thresholds):
+                k = _first_pair_at_least(p, sorted_probabilities, threshold)
+                if k == len(right):
+                    continue
+                above_next_side = sum_next_side - tree_next_side.prefix_sum(k)
+                above_prev_side = sum_prev_side - tree_prev_side.prefix_sum(k)
+                if _ends_on_prev_side(keys[traj]):
+                    totals[t] += p * above_prev_side * 0.5
+                else:
+                    totals[t] += p * (above_next_side * 0.5 + above_prev_side)
+        merged[pos] = traj
+
+    merged[:right_index + 1] = right[:right_index + 1]
+
+    return merged
+
+
+def _sort_and_count_thresholds(keys, probabilities, order, thresholds, totals):
+    """
+    Index based merge_and_count restricted to pairs with p_i * p_j above
+    each of the thresholds. Runs in O(n log^2 n) per threshold.
+
+    :param order: indices sorted by start alpha
+    :return: Indices sorted by end key
+    """
+
+    if len(order) <= 1:
+        return list(order)
+
+    mid = len(order) // 2
+    left = _sort_and_count_thresholds(
+        keys, probabilities, order[:mid], thresholds, totals)
+    right = _sort_and_count_thresholds(
+        keys, probabilities, order[mid:], thresholds, totals)
+
+    return _merge_runs_thresholds(
+        keys, probabilities, left, right, thresholds, totals)
+
+
+def _corner_chords(trajectories):
+    """
+    Group trajectories by the corner they cut off. A trajectory of corner s
+    joins side s and side s + 1 and is stored as (e, f, p), with e its alpha
+    on side s and f its alpha on side s + 1.
+
+    Two trajectories of the same corner meet iff e and f are in the same
+    order, and a trajectory X of corner s meets a trajectory Y of corner
+    s + 1 iff f_X > e_Y (both alphas lie on side s + 1).
+
+    :return: list of (e, f, p) lists, one per corner
+    """
+
+    corners = [[], [], []]
+    for traj in trajectories:
+        if traj.end.s == (traj.start.s + 1) % 3:
+            first, second = traj.start, traj.end
+        elif traj.start.s == (traj.end.s + 1) % 3:
+            first, second = traj.end, traj.start
+        else:
+            raise ValueError("traj has two endpoints on side")
+        corners[first.s].append((first.alpha, second.alpha, traj.probability))
+
+    return corners
+
+
+def _increasing_triples(chords):
+    """
+    :param chords: (e, f, p) of one corner
+    :return: sum of p_i p_j p_k over triples increasing in both e and f
+    """
+
+    chords = sorted(chords)
+    fs = sorted(f for _, f, _ in chords)
+    singles = FenwickTree(len(fs))
+    pairs = FenwickTree(len(fs))
+
+    total = 0.0
+    for _, f, p in chords:
+        r = bisect_left(fs, f)
+        below = singles.prefix_sum(r)
+        total += p * pairs.prefix_sum(r)
+        singles.add(r, p)
+        pairs.add(r, p * below)
+
+    return total
+
+
+def _meeting_pairs_by_threshold(chords, by_f):
+    """
+    Sum of p_i p_j over meeting pairs of one corner, restricted to chords on
+    one side of a threshold.
+
+    :param chords: (e, f, p) of one corner
+    :param by_f: restrict to f > t if True, else to e < t
+    :return: (thresholds, totals) where totals[i] is the sum for the chords
+             past thresholds[i]: for by_f, totals[i] covers the chords with
+             f > thresholds[i] (thresholds descending), otherwise the chords
+             with e < thresholds[i] (thresholds ascending)
+    """
+
+    if by_f:
+        # add chords from the largest f down; a new chord meets the added
+        # chords with a larger e
+        chords = sorted(chords, key=lambda c: -c[1])
+        es = sorted(e for e, _, _ in chords)
+        tree = FenwickTree(len(es))
+        added = 0.0
+        thresholds, totals, total = [], [], 0.0
+        for e, f, p in chords:
+            r = bisect_left(es, e)
+            total += p * (added - tree.prefix_sum(r + 1))
+            tree.add(r, p)
+            added += p
+            thresholds.append(f)
+            totals.append(total)
+    else:
+        # add chords from the smallest e up; a new chord meets the added
+        # chords with a smaller f
+        chords = sorted(chords)
+        fs = sorted(f for _, f, _ in chords)
+        tree = FenwickTree(len(fs))
+        thresholds, totals, total = [], [], 0.0
+        for e, f, p in chords:
+            r = bisect_left(fs, f)
+            total += p * tree.prefix_sum(r)
+            tree.add(r, p)
+            thresholds.append(e)
+            totals.append(total)
+
+    return thresholds, totals
+
+
+def _pairs_meeting_third_corner(pairs_corner, next_corner, prev_corner):
+    """
+    Sum of p_i p_j p_k over meeting pairs i, j of pairs_corner whose members
+    both meet a trajectory k of next_corner or of prev_corner.
+    """
+
+    total = 0.0
+
+    # k of the next corner meets X iff f_X > e_k
+    thresholds, totals = _meeting_pairs_by_threshold(pairs_corner, True)
+    negated = [-t for t in thresholds]
+    for e, _, p in next_corner:
+        count = bisect_left(negated, -e)
+        if count:
+            total += p * totals[count - 1]
+
+    # k of the previous corner meets X iff f_k > e_X
+    thresholds, totals = _meeting_pairs_by_threshold(pairs_corner, False)
+    for _, f, p in prev_corner:
+        count = bisect_left(thresholds, f)
+        if count:
+            total += p * totals[count - 1]
+
+    return total
+
+
+def _cyclic_triples(corner_a, corner_b, corner_c):
+    """
+    Sum of p_a p_b p_c over mutually meeting triples with one trajectory of
+    each corner, i.e. f_a > e_b, f_b > e_c and f_c > e_a.
+
+    Each condition compares alphas on a different side, so no single sort
+    order removes a dimension. For each b the a's with f_a > e_b are a
+    prefix of corner_a by decreasing f, and the c's with e_c < f_b a prefix
+    of corner_c by increasing e. The a prefix is cut into blocks of size
+    about sqrt(n). Whole blocks are answered from prefix sums over c, and
+    the rest of the a prefix by offline dominance queries over c. Runs in
+    O(n sqrt(n) log n).
+    """
+
+    if not (corner_a and corner_b and corner_c):
+        return 0.0
+
+    a_list = sorted(corner_a, key=lambda c: -c[1])
+    a_fs = sorted(f for _, f, _ in corner_a)
+    a_es = sorted(e for e, _, _ in corner_a)
+    c_list = sorted(corner_c)
+    c_es = [e for e, _, _ in c_list]
+    c_fs = sorted(f for _, f, _ in corner_c)
+
+    block = isqrt(len(a_list)) + 1
+
+    # queries: (number of a's, number of c's, p_b)
+    queries = []
+    for e, f, p in corner_b:
+        k = len(a_fs) - bisect_right(a_fs, e)
+        t = bisect_left(c_es, f)
+        if k and t:
+            queries.append((k, t, p))
+    queries.sort()
+
+    total = 0.0
+
+    # whole blocks: a_list[:start] against c_list[:t]
+    tree = FenwickTree(len(a_es))
+    inserted = 0
+    partial = []
+    q = 0
+    while q < len(queries):
+        start = queries[q][0] // block * block
+        while inserted < start:
+            e, _, p = a_list[inserted]
+            tree.add(bisect_left(a_es, e), p)
+            inserted += 1
+
+        prefix = [0.0]
+        if start:
+            for _, f, p in c_list:
+                prefix.append(prefix[-1] + p * tree.prefix_sum(bisect_left(a_es, f)))
+
+        while q < len(queries) and queries[q][0] < start + block:
+            k, t, p = queries[q]
+            if start:
+                total += p * prefix[t]
+            for i in range(start, k):
+                e, _, p_a = a_list[i]
+                partial.append((t, e, p * p_a))
+            q += 1
+
+    # the rest: sum of p_c over c_list[:t] with f_c > e
+    partial.sort()
+    tree = FenwickTree(len(c_fs))
+    added = 0.0
+    j = 0
+    for t, e, weight in partial:
+        while j < t:
+            _, f, p = c_list[j]
+            tree.add(bisect_left(c_fs, f), p)
+            added += p
+            j += 1
+        total += weight * (added - tree.prefix_sum(bisect_right(c_fs, e)))
+
+    return total
+
+
+class PreparedSystem:
+    """
+    Prepared System
+    The per side pivots of a list of trajectories, built once and reused by
+    every query on the system.
+
+    For each side the pivot holds the trajectories that start or end on the
+    side, ordered by alpha along the side, with
+    - keys: the far endpoint as an integer, 2 * rank + flag, where rank is
+      its clockwise order from the side among the pivot and flag is 1 if it
+      lies on the previous side
+    - probabilities: the trajectory probabilities
+    - indices: the position of the trajectories in the system
+
+    A compact prepared system stores the keys and indices as uint32 and the
+    probabilities as float32, half the size of the default int64 / float64
+    arrays, and the merge and count sweeps those arrays directly. Sums are
+    still accumulated in float64; see error_bound.
+    """
+
+    def __init__(self, n_trajectories: int, pivots: list):
+        """
+        Initialise the prepared system
+        :param n_trajectories: number of trajectories in the system
+        :param pivots: (keys, probabilities, indices) arrays for each side
+        """
+
+        self.n_trajectories = n_trajectories
+        self.pivots = pivots
+
+    @classmethod
+    def build(cls, trajectories: list, compact: bool = False):
+        """
+        Pivot the trajectories on every side in O(n log n) time.
+        :param trajectories: List of trajectories
+        :param compact: store uint32 keys and float32 probabilities
+        :return: PreparedSystem
+        """
+
+        if compact:
+            if 2 * len(trajectories) >= 2 ** 32:
+                raise ValueError("too many trajectories for a compact system")
+            int_code, float_code = 'I', 'f'
+        else:
+            int_code, float_code = 'q', 'd'
+
+        pivots = []
+        for side in QuantumTriangleSystem.sides:
+            next_side = (side + 1) % 3
+            prev_side = (side + 2) % 3
+
+            starts = array('d')
+            ends = array('d')
+            flags = array('B')
+            probabilities = array(float_code)
+            indices = array(int_code)
+            for index, traj in enumerate(trajectories):
+                if traj.start.s == side:
+                    start, end = traj.start, traj.end
+                elif traj.end.s == side:
+                    start, end = traj.end, traj.start
+                else:
+                    continue
+
+                if end.s == next_side:
+                    flags.append(0)
+                elif end.s == prev_side:
+                    flags.append(1)
+                else:
+                    raise ValueError("traj has two endpoints on side")
+                starts.append(start.alpha)
+                ends.append(end.alpha)
+                probabilities.append(traj.probability)
+                indices.append(index)
+
+            # reorder by start alpha
+            order = sorted(range(len(starts)), key=starts.__getitem__)
+            ends = array('d', (ends[i] for i in order))
+            flags = array('B', (flags[i] for i in order))
+            probabilities = array(float_code, (probabilities[i] for i in order))
+            indices = array(int_code, (indices[i] for i in order))
+            del starts, order
+
+            # rank the ends clockwise from side: next side first, then prev
+            by_end = sorted(
+                sorted(range(len(ends)), key=ends.__getitem__),
+                key=flags.__getitem__)
+            keys = array(int_code, [0]) * len(ends)
+            for rank, i in enumerate(by_end):
+                keys[i] = 2 * rank + flags[i]
+
+            pivots.append((keys, probabilities, indices))
+
+        return cls(len(trajectories), pivots)
+
+    @property
+    def compact(self) -> bool:
+        """
+        True if the probabilities are stored as float32.
+        """
+
+        return self.pivots[0][1].typecode == 'f'
+
+    def check(self, trajectories: list):
+        """
+        Check in O(n) time that this prepared system was built from
+        trajectories: every pivot holds each trajectory touching its side
+        once, in order of start alpha, with the trajectory's probability
+        (rounded to float32 if compact), the side of its far end in the key
+        flag, and end keys in clockwise order of the far ends.
+        Raises ValueError otherwise.
+        """
+
+        if self.n_trajectories != len(trajectories):
+            raise ValueError("prepared system does not match trajectories")
+
+        touching = [0] * 3
+        for traj in trajectories:
+            if not (0 <= traj.start.s < 3 and 0 <= traj.end.s < 3):
+                raise ValueError("traj endpoint is not on the triangle")
+            if traj.start.s == traj.end.s:
+                raise ValueError("traj has two endpoints on side")
+            touching[traj.start.s] += 1
+            touching[traj.end.s] += 1
+
+        for side in QuantumTriangleSystem.sides:
+            keys, probabilities, indices = self.pivots[side]
+            if len(keys) != touching[side]:
+                raise ValueError("prepared system does not match trajectories")
+
+            prev_side = (side + 2) % 3
+            end_alphas = [None] * len(keys)
+            n_next_side = 0
+            previous_alpha = previous_index = None
+            for key, index in zip(keys, indices):
+                if not 0 <= index < len(trajectories):
+                    raise ValueError("prepared system does not match trajectories")
+                start, end = trajectories[index].start, trajectories[index].end
+                if start.s != side:
+                    start, end = end, start
+                rank = key >> 1
+                if (start.s != side or
+                        (end.s == prev_side) != _ends_on_prev_side(key) or
+                        not 0 <= rank < len(keys) or
+                        end_alphas[rank] is not None):
+                    raise ValueError("prepared system does not match trajectories")
+                end_alphas[rank] = end.alpha
+                if not _ends_on_prev_side(key):
+                    n_next_side += 1
+
+                # ties in start alpha are kept in trajectory order
+                alpha = start.alpha
+                if previous_alpha is not None and (
+                        alpha < previous_alpha or
+                        alpha == previous_alpha and index <= previous_index):
+                    raise ValueError("prepared system does not match trajectories")
+                previous_alpha, previous_index = alpha, index
+
+            # clockwise: ends on the next side by alpha, then the previous side
+            for first, last in ((0, n_next_side), (n_next_side, len(keys))):
+                run = end_alphas[first:last]
+                if not all(map(le, run, run[1:])):
+                    raise ValueError("prepared system does not match trajectories")
+            if any(not _ends_on_prev_side(key) for key in keys
+                   if key >> 1 >= n_next_side):
+                raise ValueError("prepared system does not match trajectories")
+
+            expected = array(probabilities.typecode,
+                             (trajectories[index].probability for index in indices))
+            if expected != probabilities:
+                raise ValueError("prepared system does not match trajectories")
+
+    def error_bound(self, expected: float) -> float:
+        """
+        Bound on |expected - float64 result| for an expected number of
+        entanglements counted from this system, assuming every probability is
+        0 or at least 2^-126 (float32 normal range).
+
+        Rounding to float32 moves each p_i by at most u = 2^-24 relative, so
+        each p_i p_j by at most 2u + u^2 relative. Both results are sums of
+        non negative terms taking at most k = 4n + 4 float64 operations, each
+        within gamma_k = k 2^-53 / (1 - k 2^-53) relative of its exact value.
+
+        :param expected: result counted from this system
+        :return: 0.0 for a float64 system
+        """
+
+        if not self.compact:
+            return 0.0
+
+        u = 2.0 ** -24
+        k = 4 * self.n_trajectories + 4
+        gamma = k * 2.0 ** -53 / (1 - k * 2.0 ** -53)
+        rounding = (2 * u + u * u) / (1 - u) ** 2
+
+        # exact compact sum <= expected / (1 - gamma), exact float64 sum
+        # <= exact compact sum / (1 - u)^2; pad for rounding in the bound
+        bound = expected / (1 - gamma) * (gamma + rounding + gamma / (1 - u) ** 2)
+
+        return bound * (1 + 2.0 ** -48)
+
+    def pivot(self, side):
+        """
+        :param side: Side of the quantum triangle
+        :return: (keys, probabilities, indices) arrays ordered by start alpha,
+                 shared with the prepared system and not to be modified
+        """
+
+        return self.pivots[side]
+
+    def save(self, path):
+        """
+        Save the prepared system to path: a header with the format version,
+        byte order, typecodes and lengths, followed by the raw arrays.
+        """
+
+        keys, probabilities, _ = self.pivots[0]
+        header = _PREPARED_HEADER.pack(
+            _PREPARED_MAGIC, _PREPARED_VERSION, sys.byteorder == "big",
+            keys.typecode.encode(), probabilities.typecode.encode(),
+            self.n_trajectories, *[len(pivot[0]) for pivot in self.pivots])
+
+        with open(path, "wb") as f:
+            f.write(header)
+            for pivot in self.pivots:
+                for values in pivot:
+                    values.tofile(f)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a prepared system saved with save, checking the header, the
+        array lengths and that every key and index is in range.
+        :return: PreparedSystem
+        """
+
+        with open(path, "rb") as f:
+            header = f.read(_PREPARED_HEADER.size)
+            if len(header) != _PREPARED_HEADER.size:
+                raise ValueError("not a prepared system file")
+            (magic, version, big_endian, int_code, float_code,
+             n_trajectories, *lengths) = _PREPARED_HEADER.unpack(header)
+
+            if magic != _PREPARED_MAGIC:
+                raise ValueError("not a prepared system file")
+            if version != _PREPARED_VERSION:
+                raise ValueError(
+                    "unsupported prepared system version {}".format(version))
+            codes = (int_code.decode("ascii", "replace"),
+                     float_code.decode("ascii", "replace"))
+            if codes not in _PREPARED_TYPECODES:
+                raise ValueError("unsupported typecodes {}".format(codes))
+            if sum(lengths) != 2 * n_trajectories:
+                raise ValueError("pivot lengths do not match trajectories")
+
+            pivots = []
+            for length in lengths:
+                pivot = []
+                for code in (codes[0], codes[1], codes[0]):
+                    values = array(code)
+                    try:
+                        values.fromfile(f, length)
+                    except EOFError:
+                        raise ValueError("truncated prepared system file")
+                    if big_endian != (sys.byteorder == "big"):
+                        values.byteswap()
+                    pivot.append(values)
+
+                keys, _, indices = pivot
+                if length and (min(keys) < 0 or max(keys) >> 1 >= length or
+                               min(indices) < 0 or
+                               max(indices) >= n_trajectories):
+                    raise ValueError("prepared system index out of range")
+                pivots.append(tuple(pivot))
+
+            if f.read(1):
+                raise ValueError("trailing data in prepared system file")
+
+        return cls(n_trajectories, pivots)
+
 
 class QuantumTriangleSystem:
     """
@@ -46,19 +1108,63 @@ class QuantumTriangleSystem:
 
     sides = [0, 1, 2]
 
-    def __init__(self, trajectories: list):
+    def __init__(self, trajectories: list, prepared: PreparedSystem = None,
+                 compact: bool = None):
         """
         Initialise trajectories
         :param trajectories: List of trajectories
+        :param prepared: PreparedSystem of the same trajectories, e.g. loaded
+                         from disk, built on demand if not given
+        :param compact: build the PreparedSystem with float32 probabilities
+                        and uint32 keys, see PreparedSystem.error_bound;
+                        defaults to the mode of prepared if given, else False
         """
 
+        if prepared is not None:
+            prepared.check(trajectories)
+            if compact is not None and compact != prepared.compact:
+                raise ValueError("compact does not match the prepared system")
+            compact = prepared.compact
+
         self.trajectories = trajectories.copy()
+        self.prepared = prepared
+        self.compact = bool(compact)
+        self.cumulative_probabilities = None
+
+    @classmethod
+    def from_prepared(cls, prepared: PreparedSystem):
+        """
+        A system that keeps only the prepared index, e.g. a compact one
+        loaded from disk, and none of the trajectories. Queries that only
+        need the pivots work; the others raise ValueError.
+
+        :param prepared: PreparedSystem
+        :return: QuantumTriangleSystem with trajectories None
+        """
+
+        system = cls([], compact=prepared.compact)
+        system.trajectories = None
+        system.prepared = prepared
 
-    def expected_entanglements_on_side_quadratic(self, side):
+        return system
+
+    def require_trajectories(self):
+        """
+        Raise ValueError if the system only keeps its prepared index.
+        """
+
+        if self.trajectories is None:
+            raise ValueError("system only keeps its prepared index, "
+                             "see from_prepared")
+
+    def expected_entanglements_on_side_quadratic(self, side, min_pair_probability=None):
         """
         calculated expected entalgelments of trajectories that start or end on side
+        only counting pairs with p_i * p_j >= min_pair_probability, if given
         """
 
+        self.require_trajectories()
+
         # swap start and end and reorient trajectories so that they start on side
         pivot = []
         for traj in self.trajectories:
@@ -88,6 +1194,10 @@ class QuantumTriangleSystem:
             next_side = (side + 1) % 3
             prev_side = (side + 2) % 3
 
+            if (min_pair_probability is not None and
+                    first.probability * second.probability < min_pair_probability):
+                continue
+
             # if first -> next and second -> prev, count it fully
             if first.end.s == next_side and second.end.s == prev_side:
                 expected += first.probability * second.probability
@@ -98,18 +1208,21 @@ class QuantumTriangleSystem:
         return expected
 
 
-    def calculate_expected_entanglements_quadratic(self) -> float:
+    def calculate_expected_entanglements_quadratic(self, min_pair_probability=None) -> float:
         """
         Calculates the expected entanglements in the list of trajectories.
         Runs in O(n^2) time.
 
+        :param min_pair_probability: if given, only count pairs with
+                                     p_i * p_j >= min_pair_probability
         :return: The expected number of entanglements.
         """
 
         expected = 0.0
 
         for side in QuantumTriangleSystem.sides:
-            expected += self.expected_entanglements_on_side_quadratic(side)
+            expected += self.expected_entanglements_on_side_quadratic(
+                side, min_pair_probability)
 
         return expected
 
@@ -210,43 +1323,427 @@ class QuantumTriangleSystem:
         return (sorted_trajectories, expected)
 
 
+    def prepare(self) -> PreparedSystem:
+        """
+        Builds the per side pivots once, so later queries skip the
+        O(n log n) preprocessing. The trajectories must not change afterwards.
+
+        :return: The prepared system, which can be saved and passed back to
+                 QuantumTriangleSystem in another process.
+        """
+
+        if self.prepared is None:
+            self.prepared = PreparedSystem.build(self.trajectories, self.compact)
+
+        return self.prepared
+
     def expected_entanglements_on_side(self, side):
         """
         calculated expected entalgelments of trajectories that start or end on side
         """
 
+        keys, probabilities, _ = self.pivot_keys(side)
 
-        # swap start and end and reorient trajectories so that they start on side
-        pivot = []
-        for traj in self.trajectories:
-            if traj.start.s == side:
-                pivot.append(
-                    QuarkTrajectory(traj.start, traj.end, traj.probability)
-                )
-            elif traj.end.s == side:
-                pivot.append(
-                    QuarkTrajectory(traj.end, traj.start, traj.probability)
-                )
-            else:
-                # ignore this traj
-                pass
+        return _sort_and_count(keys, probabilities)
 
-        pivot.sort(key=lambda x: x.start.alpha)
+    def pivot_keys(self, side):
+        """
+        Pivot the trajectories that start or end on side, see PreparedSystem.
 
-        return self.merge_and_count(pivot)[-1]
+        :param side: Side of the quantum triangle
+        :return: (keys, probabilities, indices) ordered by start alpha along
+                 side, where indices index into self.trajectories
+        """
 
-    def calculate_expected_entanglements(self) -> float:
+        return self.prepare().pivot(side)
+
+    def expected_entanglements_on_side_parallel(self, side, processes=None,
+                                                pool=None):
+        """
+        Same as expected_entanglements_on_side, but the merge and count of the
+        pivot is spread over several processes.
+
+        :param side: Side of the quantum triangle
+        :param processes: number of worker processes, defaults to the cpu count
+        :param pool: multiprocessing Pool of processes workers to reuse
+        :return: The expected number of entanglements on side
+        """
+
+        keys, probabilities, _ = self.pivot_keys(side)
+
+        if processes is None:
+            processes = os.cpu_count() or 1
+
+        # not worth the process pool for tiny pivots
+        if processes <= 1 or len(keys) < 2 * processes:
+            return _sort_and_count(keys, probabilities)
+
+        return count_side_parallel(keys, probabilities, processes, pool)
+
+    def calculate_expected_entanglements_parallel(self, processes=None) -> float:
+        """
+        Calculates the expected entanglements, running the merge and count
+        of each side over one pool of processes.
+
+        :param processes: number of worker processes, defaults to the cpu count
+        :return: The expected number of entanglements.
+        """
+
+        if processes is None:
+            processes = os.cpu_count() or 1
+
+        if processes <= 1:
+            return self.calculate_expected_entanglements()
+
+        expected = 0.0
+
+        with _worker_pool(processes) as pool:
+            for side in QuantumTriangleSystem.sides:
+                expected += self.expected_entanglements_on_side_parallel(
+                    side, processes, pool)
+
+        return expected
+
+    def calculate_expected_entanglements(self, min_pair_probability=None) -> float:
         """
         Calculates the expected entanglements in the list of trajectories.
         Must run in O(n log n) time, or else it will be too slow for your
         friend!
 
+        :param min_pair_probability: if given, only count pairs with
+                                     p_i * p_j >= min_pair_probability,
+                                     in O(n log^2 n) time
         :return: The expected number of entanglements.
         """
 
+        if min_pair_probability is not None:
+            return self.calculate_expected_entanglements_thresholds(
+                [min_pair_probability])[0]
+
         expected = 0.0
 
         for side in QuantumTriangleSystem.sides:
             expected += self.expected_entanglements_on_side(side)
 
         return expected
+
+    def calculate_expected_entanglements_with_error(self) -> tuple:
+        """
+        Calculates the expected entanglements from the prepared system along
+        with a bound on its distance to the float64 result, which is nonzero
+        for a compact system.
+
+        :return: (expected, error bound)
+        """
+
+        expected = self.calculate_expected_entanglements()
+
+        return expected, self.prepare().error_bound(expected)
+
+    def expected_entanglements_matrix(self, groups, n_groups):
+        """
+        Calculates the expected entanglements between every pair of groups.
+        Runs in O(n log n * n_groups) time.
+
+        :param groups: group number in range(n_groups) of each trajectory
+        :param n_groups: total number of groups
+        :return: matrix[g][h] (symmetric) is the expected number of
+                 entanglements between a trajectory in group g and one in
+                 group h, matrix[g][g] is the count within group g
+        """
+
+        matrix = [[0.0] * n_groups for _ in range(n_groups)]
+
+        for side in QuantumTriangleSystem.sides:
+            keys, probabilities, indices = self.pivot_keys(side)
+            pivot_groups = [groups[index] for index in indices]
+            _sort_and_count_by_group(
+                keys, probabilities, pivot_groups, range(len(keys)), matrix)
+
+        # each pair was added to the row of whichever comes first on the pivot
+        for g in range(n_groups):
+            for h in range(g + 1, n_groups):
+                matrix[g][h] = matrix[h][g] = matrix[g][h] + matrix[h][g]
+
+        return matrix
+
+    def calculate_expected_entanglements_by_group(self, labels) -> dict:
+        """
+        Calculates the expected entanglements between every pair of labelled
+        groups of trajectories.
+
+        :param labels: label of each trajectory, in the order of trajectories
+        :return: dict mapping (label_a, label_b) to the expected number of
+                 entanglements between pairs with one trajectory labelled
+                 label_a and the other labelled label_b
+        """
+
+        if len(labels) != self.prepare().n_trajectories:
+            raise ValueError("expected one label per trajectory")
+
+        group_of = {}
+        for label in labels:
+            group_of.setdefault(label, len(group_of))
+
+        matrix = self.expected_entanglements_matrix(
+            [group_of[label] for label in labels], len(group_of))
+
+        return {
+            (label_a, label_b): matrix[g][h]
+            for label_a, g in group_of.items()
+            for label_b, h in group_of.items()
+        }
+
+    def calculate_cross_expected_entanglements(self, labels, label_a, label_b) -> float:
+        """
+        Calculates the expected entanglements between pairs with one
+        trajectory labelled label_a and the other labelled label_b.
+
+        :param labels: label of each trajectory, in the order of trajectories
+        :return: The expected number of cross group entanglements.
+        """
+
+        if len(labels) != self.prepare().n_trajectories:
+            raise ValueError("expected one label per trajectory")
+
+        # group 2 holds every other label, so the prepared pivots are reused
+        groups = [
+            0 if label == label_a else 1 if label == label_b else 2
+            for label in labels
+        ]
+
+        matrix = self.expected_entanglements_matrix(groups, 3)
+
+        if label_a == label_b:
+            return matrix[0][0]
+
+        return matrix[0][1]
+
+    def cross_expected_entanglements(self, other) -> float:
+        """
+        Calculates the expected entanglements between the trajectories of this
+        system and the trajectories of another system on the same triangle.
+
+        :param other: QuantumTriangleSystem sharing the triangle
+        :return: The expected number of cross system entanglements.
+        """
+
+        self.require_trajectories()
+        other.require_trajectories()
+
+        system = QuantumTriangleSystem(self.trajectories + other.trajectories)
+        groups = [0] * len(self.trajectories) + [1] * len(other.trajectories)
+
+        return system.expected_entanglements_matrix(groups, 2)[0][1]
+
+    def calculate_expected_entanglements_thresholds(self, thresholds) -> list:
+        """
+        Calculates the expected entanglements restricted to pairs with
+        p_i * p_j >= threshold, for several thresholds in one sweep.
+        Runs in O(n log^2 n) time per threshold.
+
+        :param thresholds: list of minimum pair probabilities
+        :return: The expected number of entanglements for each threshold.
+        """
+
+        totals = [0.0] * len(thresholds)
+
+        for side in QuantumTriangleSystem.sides:
+            keys, probabilities, _ = self.pivot_keys(side)
+            _sort_and_count_thresholds(
+                keys, probabilities, range(len(keys)), thresholds, totals)
+
+        return totals
+
+    def estimate_expected_entanglements(self, eps=0.01, delta=0.05,
+                                        max_samples=10 ** 7, seed=None,
+                                        atol=0.0) -> Estimate:
+        """
+        Estimates the expected entanglements by sampling pairs of trajectories.
+
+        Each sample draws i and j independently with probability p / P, where
+        P is the sum of probabilities, and scores P^2 / 2 if they are distinct
+        and meet. The mean score is an unbiased estimate of E for any fixed
+        number of samples. Sampling stops once the half width of the
+        confidence interval is within eps of the estimate or within atol, or
+        after max_samples.
+
+        :param eps: target relative error
+        :param delta: the interval holds with probability about 1 - delta
+        :param max_samples: upper bound on the number of pairs sampled
+        :param seed: seed of the random number generator
+        :param atol: target absolute error, off by default; set it so that
+                     a zero or tiny E stops before max_samples
+        :return: Estimate(expected, lower, upper, samples)
+        """
+
+        self.require_trajectories()
+
+        if self.cumulative_probabilities is None:
+            cumulative = []
+            total = 0.0
+            for traj in self.trajectories:
+                total += traj.probability
+                cumulative.append(total)
+            self.cumulative_probabilities = cumulative
+
+        cumulative = self.cumulative_probabilities
+        if len(cumulative) < 2 or cumulative[-1] <= 0.0:
+            return Estimate(0.0, 0.0, 0.0, 0)
+
+        scale = cumulative[-1] ** 2 / 2
+        if max_samples <= 0:
+            return Estimate(0.0, 0.0, scale, 0)
+
+        z = NormalDist().inv_cdf(1 - delta / 2)
+        rng = random.Random(seed)
+        indices = range(len(cumulative))
+
+        batch = min(1000, max_samples)
+        hits = 0
+        samples = 0
+        while True:
+            firsts = rng.choices(indices, cum_weights=cumulative, k=batch)
+            seconds = rng.choices(indices, cum_weights=cumulative, k=batch)
+            for i, j in zip(firsts, seconds):
+                if i != j and trajectories_meet(
+                        self.trajectories[i], self.trajectories[j]):
+                    hits += 1
+            samples += batch
+
+            # Wilson score interval for the fraction of meeting samples
+            q = hits / samples
+            centre = (q + z * z / (2 * samples)) / (1 + z * z / samples)
+            half = (z / (1 + z * z / samples)) * (
+                q * (1 - q) / samples + z * z / (4 * samples * samples)) ** 0.5
+            # exactly 0 without hits, where centre - half only rounds to it
+            lower = max(centre - half, 0.0) if hits else 0.0
+            upper = min(centre + half, 1.0)
+
+            half_width = scale * (upper - lower) / 2
+            if hits and half_width <= eps * scale * q:
+                break
+            if atol > 0 and half_width <= atol:
+                break
+            if samples >= max_samples:
+                break
+            batch = min(2 * batch, max_samples - samples)
+
+        return Estimate(scale * q, scale * lower, scale * upper, samples)
+
+    def calculate_expected_triple_entanglements_cubic(self) -> float:
+        """
+        Calculates the expected number of triples of trajectories that all
+        pairwise meet, sum of p_i p_j p_k. Runs in O(n^3) time.
+
+        :return: The expected number of triple entanglements.
+        """
+
+        self.require_trajectories()
+
+        expected = 0.0
+
+        for first, second, third in combinations(self.trajectories, 3):
+            if (trajectories_meet(first, second) and
+                    trajectories_meet(first, third) and
+                    trajectories_meet(second, third)):
+                expected += first.probability * second.probability * third.probability
+
+        return expected
+
+    def calculate_expected_triple_entanglements(self) -> float:
+        """
+        Calculates the expected number of triples of trajectories that all
+        pairwise meet, sum of p_i p_j p_k.
+
+        Trajectories are grouped by the corner they cut off (see
+        _corner_chords). Triples within one corner and triples with two
+        trajectories from one corner take O(n log n) Fenwick sweeps. Triples
+        with one trajectory from each corner take O(n sqrt(n) log n).
+
+        :return: The expected number of triple entanglements.
+        """
+
+        self.require_trajectories()
+
+        corners = _corner_chords(self.trajectories)
+
+        expected = 0.0
+
+        for side in QuantumTriangleSystem.sides:
+            expected += _increasing_triples(corners[side])
+            expected += _pairs_meeting_third_corner(
+                corners[side], corners[(side + 1) % 3], corners[(side + 2) % 3])
+
+        expected += _cyclic_triples(corners[0], corners[1], corners[2])
+
+        return expected
+
+
+class QuantumPolygonSystem:
+    """
+    Quantum Polygons
+    The system to detect the expected number of entanglements from quark
+    trajectories cutting through a convex polygon with any number of sides.
+
+    Positions are (s, alpha) with s in range(n_sides) in clockwise order, as
+    for the triangle. Two trajectories meet iff their endpoints interleave
+    along the perimeter, so one sweep over the perimeter counts every pair,
+    whatever the number of sides.
+    """
+
+    def __init__(self, trajectories: list, n_sides: int):
+        """
+        Initialise trajectories
+        :param trajectories: List of trajectories
+        :param n_sides: number of sides of the convex polygon, at least 3
+        """
+
+        if n_sides < 3:
+            raise ValueError("a polygon has at least 3 sides")
+
+        for traj in trajectories:
+            if not (0 <= traj.start.s < n_sides and 0 <= traj.end.s < n_sides):
+                raise ValueError("traj endpoint is not on the polygon")
+            if traj.start.s == traj.end.s:
+                raise ValueError("traj has two endpoints on one side")
+
+        self.trajectories = trajectories.copy()
+        self.sides = list(range(n_sides))
+
+    def calculate_expected_entanglements(self) -> float:
+        """
+        Calculates the expected entanglements in the list of trajectories.
+        Runs in O(n log n) time, independent of the number of sides.
+
+        :return: The expected number of entanglements.
+        """
+
+        # endpoints as clockwise (s, alpha) positions along the perimeter,
+        # first <= last; s + alpha would merge alphas closer than an ulp
+        chords = []
+        for traj in self.trajectories:
+            first = (traj.start.s, traj.start.alpha)
+            last = (traj.end.s, traj.end.alpha)
+            if last < first:
+                first, last = last, first
+            chords.append((first, last, traj.probability))
+
+        chords.sort()
+
+        rank = {
+            position: i for i, position in enumerate(
+                sorted([c[0] for c in chords] + [c[1] for c in chords]))
+        }
+
+        # trajectories that started earlier, stored at the rank of their end;
+        # one meets the current trajectory iff it ends between its endpoints
+        tree = FenwickTree(len(rank))
+        expected = 0.0
+        for first, last, probability in chords:
+            inside = (tree.prefix_sum(rank[last]) -
+                      tree.prefix_sum(rank[first] + 1))
+            expected += probability * inside
+            tree.add(rank[last], probability)
+
+        return expected
@@ -1,10 +1,15 @@
 import math
+import os
 import random
+import tempfile
+import tracemalloc
 import unittest
 
 import timeout_decorator
 
-from quantum_traingles import QuantumTriangleSystem
+from quantum_traingles import (
+    PreparedSystem, QuantumPolygonSystem, QuantumTriangleSystem
+)
 from quark_trajectories import Position, QuarkTrajectory
 
 ###################
@@ -56,6 +61,31 @@ class SimpleTestCase(unittest.TestCase):
 
         return ans
 
+    def random_trajectories(self, n: int, seed=None) -> list:
+        """
+        Create n trajectories between random positions on different sides
+        :param n: total number of trajectories.
+        :param seed: seed for a reproducible list, else the global random
+        :return: list of QuarkTrajectory
+        """
+
+        rng = random if seed is None else random.Random(seed)
+        trajectories = []
+
+        for _ in range(n):
+            start = rng.choice(QuantumTriangleSystem.sides)
+            end = (start + rng.choice([1, 2])) % 3
+
+            trajectories.append(
+                QuarkTrajectory(
+                    Position(start, rng.random()),
+                    Position(end, rng.random()),
+                    rng.random()
+                )
+            )
+
+        return trajectories
+
     def test_same_single_cross(self):
         """ #score(1) """
 
@@ -525,4 +555,529 @@ class SimpleTestCase(unittest.TestCase):
             "Expected entanglements"
         )
 
+    def test_parallel_matches_sequential(self):
+        """ #score(2) """
+
+        trajectories = self.random_trajectories(500)
+
+        qs = QuantumTriangleSystem(trajectories)
+        expected = qs.calculate_expected_entanglements()
+
+        for processes in [1, 2, 3, 4]:
+            assert_is_close(
+                qs.calculate_expected_entanglements_parallel(processes),
+                expected,
+                "Parallel entanglements with {} processes".format(processes)
+            )
+
+    def test_parallel_side(self):
+        """ #score(1) """
+
+        trajectories = self.random_trajectories(100)
+
+        qs = QuantumTriangleSystem(trajectories)
+
+        for side in QuantumTriangleSystem.sides:
+            assert_is_close(
+                qs.expected_entanglements_on_side_parallel(side, 4),
+                qs.expected_entanglements_on_side(side),
+                "Parallel entanglements on side {}".format(side)
+            )
+
+    def test_group_matrix(self):
+        """ #score(2) """
+
+        trajectories = self.random_trajectories(300)
+        labels = [random.choice("abc") for _ in trajectories]
+
+        qs = QuantumTriangleSystem(trajectories)
+        matrix = qs.calculate_expected_entanglements_by_group(labels)
+
+        def group(label):
+            return [t for t, l in zip(trajectories, labels) if l == label]
+
+        def expected(trajs):
+            return QuantumTriangleSystem(trajs).calculate_expected_entanglements()
+
+        for a in "abc":
+            assert_is_close(
+                matrix[a, a],
+                expected(group(a)),
+                "Expected entanglements within group {}".format(a)
+            )
+            for b in "abc":
+                if a != b:
+                    assert_is_close(
+                        matrix[a, b],
+                        expected(group(a) + group(b)) -
+                        expected(group(a)) - expected(group(b)),
+                        "Expected entanglements between {} and {}".format(a, b)
+                    )
+
+        assert_is_close(
+            qs.calculate_cross_expected_entanglements(labels, "a", "b"),
+            matrix["a", "b"],
+            "Expected cross entanglements between a and b"
+        )
+
+    def test_cross_systems(self):
+        """ #score(1) """
+
+        trajectory_1 = QuarkTrajectory(Position(0, 0.7), Position(2, 0.6), 0.8)
+        trajectory_2 = QuarkTrajectory(Position(1, 0.6), Position(2, 0.85), 0.9)
+        trajectory_3 = QuarkTrajectory(Position(0, 0.2), Position(1, 0.1), 0.5)
+
+        qs_a = QuantumTriangleSystem([trajectory_1, trajectory_3])
+        qs_b = QuantumTriangleSystem([trajectory_2])
+
+        assert_is_close(
+            qs_a.cross_expected_entanglements(qs_b),
+            0.8 * 0.9,
+            "Expected cross entanglements between two systems"
+        )
+
+    def test_min_pair_probability(self):
+        """ #score(2) """
+
+        trajectories = self.random_trajectories(300)
+
+        qs = QuantumTriangleSystem(trajectories)
+
+        for threshold in [0.0, 0.1, 0.3, 0.6, 1.0]:
+            assert_is_close(
+                qs.calculate_expected_entanglements(min_pair_probability=threshold),
+                qs.calculate_expected_entanglements_quadratic(threshold),
+                "Expected entanglements above {}".format(threshold)
+            )
+
+    def test_thresholds_batch(self):
+        """ #score(1) """
+
+        trajectories = self.random_trajectories(200)
+        thresholds = [0.05, 0.2, 0.5]
+
+        qs = QuantumTriangleSystem(trajectories)
+        totals = qs.calculate_expected_entanglements_thresholds(thresholds)
+
+        for threshold, total in zip(thresholds, totals):
+            assert_is_close(
+                total,
+                qs.calculate_expected_entanglements_quadratic(threshold),
+                "Batched expected entanglements above {}".format(threshold)
+            )
+
+    def test_prepared_system_reused(self):
+        """ #score(1) """
+
+        trajectories = self.random_trajectories(300)
+
+        qs = QuantumTriangleSystem(trajectories)
+        prepared = qs.prepare()
+        expected = qs.calculate_expected_entanglements_quadratic()
+
+        assert qs.prepare() is prepared, "prepare should be cached"
+
+        assert_is_close(
+            qs.calculate_expected_entanglements(),
+            expected,
+            "Expected entanglements from prepared system"
+        )
+        assert_is_close(
+            qs.calculate_expected_entanglements(min_pair_probability=0.2),
+            qs.calculate_expected_entanglements_quadratic(0.2),
+            "Thresholded entanglements from prepared system"
+        )
+
+        labels = [i % 3 for i in range(len(trajectories))]
+        assert_is_close(
+            qs.calculate_cross_expected_entanglements(labels, 0, 1),
+            qs.calculate_expected_entanglements_by_group(labels)[0, 1],
+            "Cross entanglements from prepared system"
+        )
+        assert qs.prepare() is prepared, "cross query should reuse prepare"
+
+    def test_prepared_system_save_load(self):
+        """ #score(1) """
+
+        trajectories = self.random_trajectories(300)
+
+        qs = QuantumTriangleSystem(trajectories)
+        expected = qs.calculate_expected_entanglements()
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "prepared.bin")
+            qs.prepare().save(path)
+            prepared = PreparedSystem.load(path)
+
+        qs_loaded = QuantumTriangleSystem(trajectories, prepared)
+
+        assert_is_close(
+            qs_loaded.calculate_expected_entanglements(),
+            expected,
+            "Expected entanglements from loaded system"
+        )
+
+        with self.assertRaises(ValueError):
+            QuantumTriangleSystem(trajectories[1:], prepared)
+
+        with self.assertRaises(ValueError):
+            QuantumTriangleSystem(trajectories, prepared, compact=True)
+
+        # same number of trajectories, but one now touches a different side
+        first = trajectories[0]
+        other = 3 - first.start.s - first.end.s
+        moved = [QuarkTrajectory(
+            Position(other, 0.5), Position(first.start.s, 0.5), 0.5)]
+        with self.assertRaises(ValueError):
+            QuantumTriangleSystem(moved + trajectories[1:], prepared)
+
+    def test_prepared_system_rejects_other_trajectories(self):
+        """ #score(1) """
+
+        trajectories = [
+            QuarkTrajectory(Position(0, 0.3), Position(1, 0.8), 0.1),
+            QuarkTrajectory(Position(0, 0.5), Position(1, 0.85), 0.2),
+        ]
+
+        others = [
+            # other probabilities
+            [QuarkTrajectory(Position(0, 0.3), Position(1, 0.8), 0.9),
+             QuarkTrajectory(Position(0, 0.5), Position(1, 0.85), 0.9)],
+            # other order along side 0
+            [QuarkTrajectory(Position(0, 0.6), Position(1, 0.8), 0.1),
+             QuarkTrajectory(Position(0, 0.5), Position(1, 0.85), 0.2)],
+            # other order along side 1
+            [QuarkTrajectory(Position(0, 0.3), Position(1, 0.9), 0.1),
+             QuarkTrajectory(Position(0, 0.5), Position(1, 0.85), 0.2)],
+        ]
+
+        for compact in [False, True]:
+            QuantumTriangleSystem(
+                trajectories, PreparedSystem.build(trajectories, compact))
+            for other in others:
+                with self.assertRaises(ValueError):
+                    QuantumTriangleSystem(
+                        trajectories, PreparedSystem.build(other, compact))
+
+        # far end on the other side of 0, same number per side
+        mixed = [
+            QuarkTrajectory(Position(0, 0.3), Position(1, 0.8), 0.1),
+            QuarkTrajectory(Position(0, 0.5), Position(2, 0.85), 0.2),
+            QuarkTrajectory(Position(1, 0.5), Position(2, 0.5), 0.2),
+        ]
+        swapped = [
+            QuarkTrajectory(Position(0, 0.3), Position(2, 0.8), 0.1),
+            QuarkTrajectory(Position(0, 0.5), Position(1, 0.85), 0.2),
+            QuarkTrajectory(Position(1, 0.5), Position(2, 0.5), 0.2),
+        ]
+        with self.assertRaises(ValueError):
+            QuantumTriangleSystem(mixed, PreparedSystem.build(swapped))
+
+        off_triangle = [QuarkTrajectory(Position(0, 0.3), Position(5, 0.8), 0.1)]
+        with self.assertRaises(ValueError):
+            QuantumTriangleSystem(
+                off_triangle, PreparedSystem.build(trajectories[:1]))
+
+    def test_prepared_system_rejects_bad_files(self):
+        """ #score(1) """
+
+        trajectories = self.random_trajectories(50)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "prepared.bin")
+            PreparedSystem.build(trajectories).save(path)
+            with open(path, "rb") as f:
+                data = f.read()
+
+            for bad in [b"", b"not a prepared system", data[:-1],
+                        data + b"\0", data[:8] + b"\x02\0" + data[10:]]:
+                with open(path, "wb") as f:
+                    f.write(bad)
+                with self.assertRaises(ValueError):
+                    PreparedSystem.load(path)
+
+    def test_polygon_matches_triangle(self):
+        """ #score(2) """
+
+        trajectories = self.random_trajectories(500)
+
+        assert_is_close(
+            QuantumPolygonSystem(trajectories, 3).calculate_expected_entanglements(),
+            QuantumTriangleSystem(trajectories).calculate_expected_entanglements(),
+            "Expected triangle entanglements from polygon system"
+        )
+
+    def test_polygon_close_alphas(self):
+        """ #score(1) """
+
+        # s + alpha would round both ends on side 2 to the same position
+        trajectories = [
+            QuarkTrajectory(Position(0, 0.3), Position(2, 0.5), 0.5),
+            QuarkTrajectory(Position(1, 0.5), Position(2, math.nextafter(0.5, 1)), 0.5),
+        ]
+
+        expected = QuantumTriangleSystem(trajectories).calculate_expected_entanglements()
+
+        assert_is_close(expected, 0.25, "Expected triangle entanglements")
+        assert_is_close(
+            QuantumPolygonSystem(trajectories, 3).calculate_expected_entanglements(),
+            expected,
+            "Expected polygon entanglements for close alphas"
+        )
+        assert_is_close(
+            QuantumTriangleSystem(trajectories).calculate_expected_entanglements_quadratic(),
+            expected,
+            "Expected quadratic entanglements for close alphas"
+        )
+
+    def test_square_diagonals(self):
+        """ #score(1) """
+
+        trajectories = [
+            QuarkTrajectory(Position(0, 0.5), Position(2, 0.5), 0.5),
+            QuarkTrajectory(Position(1, 0.5), Position(3, 0.5), 0.8),
+            QuarkTrajectory(Position(0, 0.2), Position(3, 0.9), 0.9),
+        ]
+
+        qs = QuantumPolygonSystem(trajectories, 4)
+
+        assert_is_close(
+            qs.calculate_expected_entanglements(),
+            0.5 * 0.8,
+            "Expected entanglements for crossing square diagonals"
+        )
+
+    def test_polygon_rejects_same_side(self):
+        """ #score(1) """
+
+        trajectories = [
+            QuarkTrajectory(Position(4, 0.2), Position(4, 0.7), 0.5),
+        ]
+
+        with self.assertRaises(ValueError):
+            QuantumPolygonSystem(trajectories, 6)
+
+    def test_estimate_expected_entanglements(self):
+        """ #score(2) """
+
+        trajectories = self.random_trajectories(2000, seed=31)
+
+        qs = QuantumTriangleSystem(trajectories)
+        expected = qs.calculate_expected_entanglements()
+        estimate = qs.estimate_expected_entanglements(0.02, 0.0001, seed=7)
+
+        assert estimate.lower <= expected <= estimate.upper, \
+            "[Estimate] {} not in [{}, {}]".format(
+                expected, estimate.lower, estimate.upper)
+        assert_is_close(
+            estimate.expected / expected,
+            1.0,
+            "Estimated entanglements relative to exact",
+            err=0.1
+        )
+
+    def test_estimate_max_samples(self):
+        """ #score(1) """
+
+        qs = QuantumTriangleSystem(self.random_trajectories(100, seed=3))
+
+        for max_samples in [0, 10, 1500]:
+            estimate = qs.estimate_expected_entanglements(
+                1e-9, max_samples=max_samples, seed=1)
+            assert estimate.samples == max_samples, \
+                "[Estimate] {} samples for max_samples={}".format(
+                    estimate.samples, max_samples)
+
+    def test_estimate_no_entanglements(self):
+        """ #score(1) """
+
+        # parallel chords cutting off the same corner never meet
+        trajectories = [
+            QuarkTrajectory(Position(0, 0.1 * i), Position(1, 1 - 0.1 * i), 0.5)
+            for i in range(1, 10)
+        ]
+
+        qs = QuantumTriangleSystem(trajectories)
+        estimate = qs.estimate_expected_entanglements(seed=1, atol=0.01)
+
+        assert estimate.samples < 10 ** 6, \
+            "[Estimate] {} samples for no entanglements".format(estimate.samples)
+        assert estimate.lower <= 0.0 <= estimate.upper, \
+            "[Estimate] 0 not in [{}, {}]".format(estimate.lower, estimate.upper)
+
+    def test_estimate_rare_entanglements(self):
+        """ #score(1) """
+
+        # many chords of one corner that never meet each other
+        trajectories = [
+            QuarkTrajectory(Position(0, i / 2001), Position(1, 1 - i / 2001), 0.5)
+            for i in range(1, 2001)
+        ] + self.random_trajectories(20, seed=11)
+
+        qs = QuantumTriangleSystem(trajectories)
+        expected = qs.calculate_expected_entanglements()
+        estimate = qs.estimate_expected_entanglements(0.2, seed=3)
+
+        assert (estimate.upper - estimate.lower) / 2 <= 0.2 * estimate.expected, \
+            "[Estimate] [{}, {}] wider than the relative target".format(
+                estimate.lower, estimate.upper)
+        total = sum(traj.probability for traj in trajectories)
+        assert expected < 0.01 * total ** 2 / 2, "[Estimate] E is not rare"
+        assert abs(estimate.expected / expected - 1) <= 0.4, \
+            "[Estimate] {} far from {}".format(estimate.expected, expected)
+
+    def test_estimate_no_trajectories(self):
+        """ #score(1) """
+
+        estimate = QuantumTriangleSystem([]).estimate_expected_entanglements()
+
+        assert_is_close(
+            estimate.expected,
+            0.0,
+            "expected 0 estimated entanglements for no trajectories"
+        )
+
+    def test_triple_entanglements(self):
+        """ #score(2) """
+
+        trajectories = self.random_trajectories(80)
+
+        qs = QuantumTriangleSystem(trajectories)
+
+        assert_is_close(
+            qs.calculate_expected_triple_entanglements(),
+            qs.calculate_expected_triple_entanglements_cubic(),
+            "Expected triple entanglements"
+        )
+
+    def test_triple_entanglements_one_per_corner(self):
+        """ #score(1) """
+
+        trajectories = [
+            QuarkTrajectory(Position(0, 0.5), Position(1, 0.5), 0.5),
+            QuarkTrajectory(Position(1, 0.4), Position(2, 0.6), 0.4),
+            QuarkTrajectory(Position(2, 0.4), Position(0, 0.6), 0.3),
+            QuarkTrajectory(Position(0, 0.1), Position(1, 0.9), 0.2),
+        ]
+
+        qs = QuantumTriangleSystem(trajectories)
+
+        assert_is_close(
+            qs.calculate_expected_triple_entanglements(),
+            qs.calculate_expected_triple_entanglements_cubic(),
+            "Expected triple entanglements"
+        )
+
+    def test_compact_within_error_bound(self):
+        """ #score(2) """
+
+        trajectories = self.random_trajectories(1000)
+
+        expected = QuantumTriangleSystem(
+            trajectories).calculate_expected_entanglements()
+        compact, bound = QuantumTriangleSystem(
+            trajectories, compact=True).calculate_expected_entanglements_with_error()
+
+        assert 0.0 < bound < 1e-5 * expected, \
+            "[Compact] bound {} for {}".format(bound, expected)
+        assert abs(compact - expected) <= bound, \
+            "[Compact] {} not within {} of {}".format(compact, bound, expected)
+
+    def test_compact_prepared_system(self):
+        """ #score(1) """
+
+        trajectories = self.random_trajectories(100)
+
+        prepared = PreparedSystem.build(trajectories)
+        compact = PreparedSystem.build(trajectories, compact=True)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "prepared.bin")
+            compact.save(path)
+            loaded = PreparedSystem.load(path)
+
+        assert loaded.compact and not prepared.compact, \
+            "[Compact] compact flag not kept"
+        for side in QuantumTriangleSystem.sides:
+            for array_64, array_32 in zip(prepared.pivots[side], loaded.pivots[side]):
+                assert array_32.itemsize * 2 == array_64.itemsize, \
+                    "[Compact] {} is not half of {}".format(
+                        array_32.typecode, array_64.typecode)
+            assert prepared.pivot(side)[0] == loaded.pivot(side)[0], \
+                "[Compact] keys differ on side {}".format(side)
+
+    def test_compact_query_memory(self):
+        """ #score(1) """
+
+        trajectories = self.random_trajectories(3000, seed=5)
+
+        peaks = []
+        for compact in [False, True]:
+            qs = QuantumTriangleSystem(trajectories, compact=compact)
+            qs.prepare()
+
+            tracemalloc.start()
+            try:
+                qs.calculate_expected_entanglements()
+                peaks.append(tracemalloc.get_traced_memory()[1])
+            finally:
+                tracemalloc.stop()
+
+        assert peaks[1] <= 0.6 * peaks[0], \
+            "[Compact] query peak {} bytes, float64 {} bytes".format(*peaks[::-1])
+
+    def test_from_prepared(self):
+        """ #score(1) """
+
+        trajectories = self.random_trajectories(300, seed=13)
+        labels = [i % 2 for i in range(len(trajectories))]
+
+        qs = QuantumTriangleSystem(trajectories, compact=True)
+        loaded = QuantumTriangleSystem.from_prepared(qs.prepare())
+
+        assert loaded.trajectories is None and loaded.compact, \
+            "[Prepared] system should only keep the compact index"
+        assert_is_close(
+            loaded.calculate_expected_entanglements(),
+            qs.calculate_expected_entanglements(),
+            "Expected entanglements from the index alone"
+        )
+        assert_is_close(
+            loaded.calculate_expected_entanglements(min_pair_probability=0.2),
+            qs.calculate_expected_entanglements(min_pair_probability=0.2),
+            "Thresholded entanglements from the index alone"
+        )
+        assert_is_close(
+            loaded.calculate_cross_expected_entanglements(labels, 0, 1),
+            qs.calculate_cross_expected_entanglements(labels, 0, 1),
+            "Cross entanglements from the index alone"
+        )
+
+        with self.assertRaises(ValueError):
+            loaded.calculate_expected_entanglements_quadratic()
+        with self.assertRaises(ValueError):
+            loaded.estimate_expected_entanglements()
+        with self.assertRaises(ValueError):
+            loaded.calculate_expected_triple_entanglements()
+
+    def test_from_prepared_retained_memory(self):
+        """ #score(1) """
 
+        tracemalloc.start()
+        try:
+            trajectories = self.random_trajectories(3000, seed=17)
+            qs = QuantumTriangleSystem(trajectories)
+            retained = tracemalloc.get_traced_memory()[0]
+
+            prepared = PreparedSystem.build(trajectories, compact=True)
+            del qs, trajectories
+            loaded = QuantumTriangleSystem.from_prepared(prepared)
+            del prepared
+            retained_compact = tracemalloc.get_traced_memory()[0]
+        finally:
+            tracemalloc.stop()
+
+        assert loaded.calculate_expected_entanglements() > 0.0
+        assert retained_compact <= 0.5 * retained, \
+            "[Compact] retains {} bytes, trajectories {} bytes".format(
+                retained_compact, retained)